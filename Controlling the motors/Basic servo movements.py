@@ -1,24 +1,19 @@
 import RPi.GPIO as GPIO
-import time
+from HyperPi_Acquisition import ServoController
 
 # Set up the GPIO
 GPIO.setmode(GPIO.BOARD)  # Use physical pin numbering
 servo_pin =  # Connect your servo data pin to GPIO Pin
 
-# Set up the servo pin
-GPIO.setup(servo_pin, GPIO.OUT)
-servo = GPIO.PWM(servo_pin, 50)  # 50Hz frequency for the servo
-
-# Start PWM with the initial position at 0 degrees
-servo.start(0)
+# Set up the servo pin, 50Hz frequency for the servo, same duty cycle and timing as the HyperPi console
+servo = ServoController(GPIO, servo_pin)
 
 def set_angle(angle):
-    duty_cycle = 2 + (angle / 19)
-    GPIO.output(servo_pin, True)
-    servo.ChangeDutyCycle(duty_cycle)
-    time.sleep(0.5)
-    GPIO.output(servo_pin, False)
-    servo.ChangeDutyCycle(0)
+    wait = servo.move(angle)
+    if wait:
+        print(f"Moved in {wait:.2f} s")
+    else:
+        print("Already there")
 
 try:
     while True:
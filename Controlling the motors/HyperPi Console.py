@@ -1,23 +1,28 @@
-import RPi.GPIO as GPIO
+import sys
 import time
 import os
 from datetime import datetime
 import tkinter as tk
 from tkinter import filedialog
-from picamera2 import Picamera2,Preview
-from libcamera import controls
 import threading
-import smbus
+import numpy as np
+from HyperPi_Acquisition import (FrameWriter, ScanPlanner, ServoController, SettleDetector, run_scan, scan_folders,
+                                 RAW_FORMAT, raw_luminance)
+from HyperPi_Hardware import LedController, open_hardware
 
 
 class CameraApp:
-    def __init__(self, root):
+    def __init__(self, root, hardware):
         self.root = root
-        GPIO.setmode(GPIO.BOARD)  # Use physical pin numbering
-        self.bus = smbus.SMBus(1)
+        self.hardware = hardware # camera, GPIO and I2C bus, real or simulated
+        self.gpio = hardware.gpio
+        self.gpio.setmode(self.gpio.BOARD)  # Use physical pin numbering
+        self.bus = hardware.bus
+        self.leds = LedController(self.bus)
         self.pins = {"Sampler" : 0,
                      "Polarizer" : 0,
                      "LED Motor": 0} # initialize the pins dictionary
+        self.servos = {} # servo controllers, created when the pins are set
         self.width = 800
         self.height = 600
         self.camera_controls = {"ExposureTime":100000,
@@ -33,9 +38,9 @@ class CameraApp:
                                 "Sharpness":1.0} # initialize the camera controls dictionary
         self.preview_thread = None # thread for start and stop preview
         self.stop_preview_event = threading.Event() # defining an event
-        self.picam2 = Picamera2() # create a picamera2 object
+        self.picam2 = hardware.camera # create a picamera2 object
         
-        self.root.title("HyperPi Project")
+        self.root.title("HyperPi Project" + (" (simulated)" if hardware.simulated else ""))
 
         # window configuration
         self.root.rowconfigure(0, weight=1)
@@ -99,21 +104,21 @@ class CameraApp:
         self.sampler_angle.grid(row = 0, column = 1, sticky = "ew", padx = 5, pady = 5)
 
         tk.Button(self.servo_controls_layout, text = "Move Sampler",
-                  command = lambda: self.set_angle(float(self.sampler_angle.get()),self.pins["Sampler"])).grid(row = 0, column = 0,
+                  command = lambda: self.set_angle(float(self.sampler_angle.get()), "Sampler")).grid(row = 0, column = 0,
                                                                                                                sticky = "ew", padx = 5, pady = 5)
 
         self.polarizer_angle = tk.Entry(self.servo_controls_layout, bg = "white", fg = "black")
         self.polarizer_angle.grid(row = 1, column = 1, sticky = "ew", padx = 5, pady = 5)
 
         tk.Button(self.servo_controls_layout, text = "Move Polarizer",
-                  command = lambda: self.set_angle(float(self.polarizer_angle.get()), self.pins["Polarizer"])).grid(row = 1, column = 0,
+                  command = lambda: self.set_angle(float(self.polarizer_angle.get()), "Polarizer")).grid(row = 1, column = 0,
                                                                                                                     sticky = "ew", padx = 5, pady = 5)
 
         self.motor_angle = tk.Entry(self.servo_controls_layout, bg = "white", fg = "black")
         self.motor_angle.grid(row = 2, column = 1, sticky = "ew", padx = 5, pady = 5)
 
         tk.Button(self.servo_controls_layout, text = "Move LEDs Motor",
-                  command = lambda: self.set_angle(float(self.motor_angle.get()), self.pins["LED Motor"])).grid(row = 2, column = 0,
+                  command = lambda: self.set_angle(float(self.motor_angle.get()), "LED Motor")).grid(row = 2, column = 0,
                                                                                                                 sticky = "ew", padx = 5, pady = 5)
 
         # End moving the motors to custom angles
@@ -206,6 +211,21 @@ class CameraApp:
         
         tk.Button(self.measurement_controls_layout, text = "Start Measurement",
                   command = self.measure, width = 30).grid(row = 4, column = 0, sticky = "ns", padx = 5, pady = 5)
+
+        #keep the camera in still mode and save frames in the background
+        self.capture_to_memory = tk.BooleanVar(value = True)
+        tk.Checkbutton(self.measurement_controls_layout, text = "Capture to memory",
+                       variable = self.capture_to_memory).grid(row = 5, column = 0, sticky = "ns", padx = 5, pady = 5)
+
+        #move on as soon as the preview frames are stable, the fixed delays are only upper bounds
+        self.adaptive_settle = tk.BooleanVar(value = True)
+        tk.Checkbutton(self.measurement_controls_layout, text = "Adaptive settle",
+                       variable = self.adaptive_settle).grid(row = 6, column = 0, sticky = "ns", padx = 5, pady = 5)
+
+        #linear 16 bit luminance from the raw sensor data, saved as .npy instead of .jpg
+        self.raw_frames = tk.BooleanVar(value = False)
+        tk.Checkbutton(self.measurement_controls_layout, text = "Raw 16 bit frames (.npy)",
+                       variable = self.raw_frames).grid(row = 7, column = 0, sticky = "ns", padx = 5, pady = 5)
     #------------------------------------------------------
     #functions
         
@@ -216,26 +236,27 @@ class CameraApp:
             self.pins["LED Motor"] = int(self.motor_pin.get())
             print("\nPins are set to")
             
+            #release the PWM channels of the previous pins
+            for servo in self.servos.values():
+                servo.stop()
+            self.servos = {}
             for key, value in self.pins.items():
                 print(key,value,sep = " pin : ")
-                GPIO.setup(value, GPIO.OUT) #set out pins
+                self.servos[key] = ServoController(self.gpio, value) #set out pins
+            self.hardware.assign_pins(self.pins)
         except:
             print("Please, enter integer values")
             
-    def set_angle(self, angle, servo_pin):
+    def set_angle(self, angle, motor):
+        #returns the seconds the servo travelled, 0 when it did not move
         if 0 <= angle <= 180:
             try:
-                servo = GPIO.PWM(servo_pin, 50)  
-                servo.start(0) #start servo
-                duty_cycle = 2 + (angle / 18)
-                servo.ChangeDutyCycle(duty_cycle)
-                time.sleep(0.5)
-                servo.ChangeDutyCycle(0)
-                servo.stop()
+                return self.servos[motor].move(angle)
             except:
                 print("An error ocurred at set_angle function")
         else:
             print("Only angles between 0 and 180 degrees are allowed")
+        return 0
         
     def start_preview(self):
         self.stop_preview_event.clear()
@@ -252,7 +273,7 @@ class CameraApp:
         print("\nPreview has ended")
 
     def preview_loop(self):
-        self.picam2.start_preview(Preview.QTGL)
+        self.picam2.start_preview(self.hardware.Preview.QTGL)
         self.set_camera_configuration()
         self.set_camera_controls()
         self.picam2.start()
@@ -352,6 +373,27 @@ class CameraApp:
             self.lens_position.insert(0,self.camera_controls["LensPosition"])
             self.set_camera_controls()
             
+    def capture_image(self, image_path, still_config):
+        if image_path.endswith(".npy"):
+            convert = lambda raw: raw_luminance(raw, self.raw_width)
+            if self.capture_to_memory.get():
+                self.frame_writer.submit(self.picam2.capture_array("raw"), image_path, convert)
+            else:
+                np.save(image_path, convert(self.picam2.switch_mode_and_capture_array(still_config, "raw")))
+                time.sleep(0.5)
+        elif self.capture_to_memory.get():
+            #the camera is already in still mode, the frame is copied out and written by another thread
+            self.frame_writer.submit(self.picam2.capture_array("main"), image_path)
+        else:
+            self.picam2.switch_mode_and_capture_file(still_config, image_path)
+            time.sleep(0.5)
+
+    def wait_settled(self, max_wait):
+        if self.adaptive_settle.get():
+            self.settle_detector.wait(max_wait)
+        else:
+            time.sleep(max_wait)
+
     def select_folder(self):
         folder_path = filedialog.askdirectory()
         if folder_path:
@@ -364,7 +406,6 @@ class CameraApp:
         if self.stop_preview_event.is_set():
             self.stop_preview_loop()
         
-        pin_list = [2,3,4,5,6,7,8,9,10,11,12,14,15,16,17]
         #wavelength_list = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 760, 800, 850, 880, 940, 980]
         wavelength_list = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 800, 850, 880, 940, 980]
         types_for_print = {int:"Int",
@@ -396,19 +437,47 @@ class CameraApp:
         for i,j in zip(sampler_angles,polarizer_angles):
             assert type(i) == float
             assert type(j) == float
+        
+        #capture order and estimated duration of the scan
+        planner = ScanPlanner([12*led for led in range(15)], capture_time = 0.1 if self.capture_to_memory.get() else 0.5)
+        order, steps, seconds = planner.plan(sampler_angles, polarizer_angles, range(15))
+        print(f"\nScan of {len(steps)} frames in {order} order, estimated duration {seconds // 60:.0f} min {seconds % 60:.0f} s")
 
         self.set_camera_configuration()
-        preview_config = self.picam2.create_preview_configuration({"size":(self.width,self.height)})
-        still_config = self.picam2.create_still_configuration({"size":(self.width,self.height)})
-        
-        self.picam2.configure(preview_config)
-        self.picam2.start_preview(Preview.QTGL)
+        #small YUV420 stream used to detect when the motors and LEDs have settled
+        lores = {"size":(min(320, self.width), min(240, self.height)), "format":"YUV420"}
+        preview_config = self.picam2.create_preview_configuration({"size":(self.width,self.height)}, lores = lores)
+        if self.raw_frames.get():
+            #the sensor mode closest to twice the size, so the 2x2 Bayer cells give about the same frame
+            still_config = self.picam2.create_still_configuration({"size":(self.width,self.height)}, lores = lores,
+                                                                  raw = {"format":RAW_FORMAT, "size":(2*self.width,2*self.height)})
+        else:
+            still_config = self.picam2.create_still_configuration({"size":(self.width,self.height)}, lores = lores)
+        #the Y plane is the first lores height rows
+        self.settle_detector = SettleDetector(lambda: self.picam2.capture_array("lores")[:lores["size"][1]])
+        
+        if self.raw_frames.get():
+            #the raw stream snaps to a real sensor mode when it is configured, so its size is read back
+            #from the applied configuration before the preview mode of file capture replaces it
+            self.picam2.configure(still_config)
+            raw_size = self.picam2.camera_configuration()["raw"]["size"]
+        self.picam2.configure(still_config if self.capture_to_memory.get() else preview_config)
+        self.picam2.start_preview(self.hardware.Preview.QTGL)
         self.set_camera_controls()
         self.picam2.start()
-        time.sleep(7)
+        self.wait_settled(7)
         
         print("Camera initialized")
         
+        #saved frames are half the raw size in raw mode
+        extension = ".jpg"
+        frame_size = (self.width, self.height)
+        if self.raw_frames.get():
+            self.raw_width = raw_size[0]
+            extension = ".npy"
+            frame_size = (raw_size[0] // 2, raw_size[1] // 2)
+        
+        self.frame_writer = FrameWriter()
         if polarizer_angles == [0.0,90.0]:
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             new_folder = os.path.join(self.parent_folder, f"Measurement_{timestamp}")
@@ -419,94 +488,41 @@ class CameraApp:
             
             # Rewrite the content of the file
             with open(controls_file_path, 'w') as file:
-                for i,j in zip(["Width","Height"],[self.width,self.height]):
+                for i,j in zip(["Width","Height"],frame_size):
                     file.write(f"{i}\t{j}\t{'Int'} \n")
                 # Write the content to the file
                 for control, value in self.camera_controls.items():
                     line = f"{control}\t{value}\t{types_for_print[type(value)]} \n"
                     file.write(line)
             
-            for sampler in sampler_angles:
-                #move sampler
-                self.set_angle(sampler,self.pins["Sampler"])
-                
-                #wait
-                time.sleep(1)
-                
-                #create copol and depol folders for this sampler angle
-                copol_folder = os.path.join(new_folder, f"Copol_Sampler_{sampler}")
-                os.makedirs(copol_folder, exist_ok=True)
-                depol_folder = os.path.join(new_folder, f"Depol_Sampler_{sampler}")
-                os.makedirs(depol_folder, exist_ok=True)
-                
-                #capture background picture
-                #move leds motor
-                self.set_angle(0, self.pins["LED Motor"])
-                #move polarizer
-                self.set_angle(0,self.pins["Polarizer"])
-                time.sleep(1)
-                #capture copol
-                image_path = os.path.join(copol_folder, "background.jpg")
-                self.picam2.switch_mode_and_capture_file(still_config, image_path)
-                time.sleep(0.5)
-                print("Copol taken")
-                #move polarizer motor
-                self.set_angle(90,self.pins["Polarizer"])
-                time.sleep(1)
-                image_path = os.path.join(depol_folder, "background.jpg")
-                self.picam2.switch_mode_and_capture_file(still_config, image_path)
-                time.sleep(0.5)
-                print("Depol taken")
-                    
-                
-                for led in range(15):
-                    #move leds motor
-                    self.set_angle(12*led, self.pins["LED Motor"])
-                    
-                    #turn on led
-                    self.bus.write_i2c_block_data(0x08, pin_list[led], [0])
-                    print("Led encendido")
-                    
-                    #move polarizer motor
-                    self.set_angle(0,self.pins["Polarizer"])
-                    
-                    time.sleep(1)
-                    
-                    #capture copol
-                    image_path = os.path.join(copol_folder, f"{wavelength_list[led]}.jpg")
-                    self.picam2.switch_mode_and_capture_file(still_config, image_path)
-                    time.sleep(0.5)
-                    print("Copol taken")
-                    
-                    #move polarizer motor
-                    self.set_angle(90,self.pins["Polarizer"])
-                    
-                    time.sleep(1)
-                    
-                    image_path = os.path.join(depol_folder, f"{wavelength_list[led]}.jpg")
-                    self.picam2.switch_mode_and_capture_file(still_config, image_path)
-                    time.sleep(0.5)
-                    print("Depol taken")
-                    
-                    #turn of led
-                    self.bus.write_i2c_block_data(0x08, pin_list[led], [1])                   
-                    print("Led apagado")
-                    time.sleep(1)
+            #same frames and files as before, in the order that moves the motors the least
+            folders = scan_folders(new_folder, sampler_angles, polarizer_angles)
+            try:
+                run_scan(steps, folders, self.servos, self.leds, lambda path: self.capture_image(path, still_config),
+                         self.wait_settled, wavelength_list, [12*led for led in range(15)], extension)
+            except Exception as e:
+                print(f"Error during the measurement: {str(e)}")
         
         self.picam2.stop_preview()
         self.picam2.stop()
+        print("Waiting for the last frames to be saved...")
+        self.frame_writer.close()
+        if self.adaptive_settle.get():
+            print(f"Settling took {self.settle_detector.waited:.1f} s, {self.settle_detector.timeouts} waits reached their limit")
         
         print("\nMeasurement concluded")
         
         
 # end CameraApp class
+#run with --simulate, or HYPERPI_SIMULATE=1, to use simulated devices off the Pi
+hardware = open_hardware("--simulate" in sys.argv or None)
 try:
     window = tk.Tk()
 
-    app = CameraApp(window)
+    app = CameraApp(window, hardware)
     window.mainloop()
     
 finally:
     print("\n","Bye","\n",sep=10*"-")
-    GPIO.cleanup()
+    hardware.gpio.cleanup()
 
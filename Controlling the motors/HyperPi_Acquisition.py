@@ -0,0 +1,268 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+class FrameWriter:
+    #saves captured frames from worker threads, so the acquisition loop only waits when
+    #max_pending frames are already waiting to be written
+    def __init__(self, workers=2, max_pending=8, quality=90):
+        self.quality = quality
+        self.frames = queue.Queue(maxsize = max_pending)
+        self.errors = []
+        self.written = 0
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target = self.work, daemon = True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, array, path, convert=None):
+        #convert runs on the writer thread, e.g. raw_luminance for raw frames
+        self.frames.put((array, path, convert))
+
+    def save(self, array, path):
+        if path.endswith(".npy"):
+            np.save(path, array)
+        else:
+            #same JPEG quality picamera2 uses in capture_file, the padding byte of XBGR8888 frames is dropped
+            Image.fromarray(array[..., :3] if array.ndim == 3 else array).save(path, quality = self.quality)
+
+    def work(self):
+        while True:
+            job = self.frames.get()
+            if job is None:
+                break
+            array, path, convert = job
+            try:
+                self.save(array if convert is None else convert(array), path)
+                with self.lock:
+                    self.written += 1
+            except Exception as e:
+                with self.lock:
+                    self.errors.append((path, str(e)))
+                print(f"Error while saving {path}: {str(e)}")
+
+    def close(self):
+        #waits until every submitted frame is on disk
+        for _ in self.threads:
+            self.frames.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#unpacked 12 bit Bayer frames, 16 bits per pixel
+RAW_FORMAT = "SRGGB12"
+RAW_BITS = 12
+
+def raw_luminance(raw, width, bits=RAW_BITS):
+    #sum of every 2x2 Bayer cell of an unpacked raw frame, so half the raw size and linear in the light,
+    #scaled so a cell with every pixel saturated reads 65535. raw comes from capture_array("raw") as
+    #bytes, rows may be padded past width pixels
+    pixels = raw.view(np.uint16)[:, :width]
+    cells = (pixels[0::2, 0::2].astype(np.uint32) + pixels[0::2, 1::2]
+             + pixels[1::2, 0::2] + pixels[1::2, 1::2])
+    return (cells * 65535 // (4 * (2**bits - 1))).astype(np.uint16)
+
+class SettleDetector:
+    #waits until successive low resolution frames stop changing, instead of a fixed sleep after moving
+    #a motor or switching a LED. capture returns the next frame and blocks until it is ready. frames are
+    #compared as grid x grid block means, so sensor noise averages out, and every block has to change
+    #less than tolerance of full_scale for stable_frames frames in a row. max_wait is the fixed delay
+    #used before, kept as an upper bound
+    def __init__(self, capture, tolerance=0.01, stable_frames=2, grid=16, full_scale=255.0, min_wait=0.05):
+        self.capture = capture
+        self.tolerance = tolerance
+        self.stable_frames = stable_frames
+        self.grid = grid
+        self.full_scale = full_scale
+        self.min_wait = min_wait
+        self.waited = 0.0
+        self.timeouts = 0
+
+    def blocks(self, frame):
+        frame = np.asarray(frame, dtype = np.float32)
+        if frame.ndim == 3:
+            frame = frame.mean(axis = 2)
+        rows, cols = frame.shape[0] // self.grid, frame.shape[1] // self.grid
+        return frame[:rows * self.grid, :cols * self.grid].reshape(self.grid, rows, self.grid, cols).mean(axis = (1, 3))
+
+    def wait(self, max_wait):
+        start = time.perf_counter()
+        #frames exposed before the servo starts moving look settled
+        time.sleep(min(self.min_wait, max_wait))
+        previous = None
+        stable = 0
+        while time.perf_counter() - start < max_wait:
+            frame = self.blocks(self.capture())
+            if previous is not None:
+                stable = stable + 1 if np.abs(frame - previous).max() < self.tolerance * self.full_scale else 0
+                if stable >= self.stable_frames:
+                    break
+            previous = frame
+        else:
+            self.timeouts += 1
+        elapsed = time.perf_counter() - start
+        self.waited += elapsed
+        return elapsed
+
+#the speed has not been measured on the rig yet, so every move still waits at least the 0.5 s it always had,
+#and long moves get 0.2 s per 60 degrees, twice the datasheet speed of SG90 class servos to allow for the load.
+#measure the loaded speed of each motor before passing shorter values to ServoController
+SERVO_MIN_WAIT = 0.5
+SERVO_SECONDS_PER_DEGREE = 0.2 / 60
+
+class ServoController:
+    #keeps the PWM channel of one servo and the angle it was last sent to, so repeated angles cost nothing
+    #and long moves wait in proportion to the distance. seconds_per_degree is the speed of the servo under
+    #load, min_wait the shortest time the pulses are kept on so the servo reaches short targets
+    def __init__(self, gpio, pin, frequency=50, seconds_per_degree=SERVO_SECONDS_PER_DEGREE, min_wait=SERVO_MIN_WAIT):
+        self.pin = pin
+        self.seconds_per_degree = seconds_per_degree
+        self.min_wait = min_wait
+        self.angle = None
+        gpio.setup(pin, gpio.OUT)
+        self.pwm = gpio.PWM(pin, frequency)
+        self.pwm.start(0)
+
+    def duty_cycle(self, angle):
+        #2% to 12% of a 20 ms period for 0 to 180 degrees
+        return 2 + (angle / 18)
+
+    def travel_time(self, angle):
+        if angle == self.angle:
+            return 0.0
+        #the first move may start anywhere
+        distance = 180.0 if self.angle is None else abs(angle - self.angle)
+        return max(self.min_wait, distance * self.seconds_per_degree)
+
+    def move(self, angle):
+        #returns the seconds waited, 0 when the servo is already there
+        if not 0 <= angle <= 180:
+            raise ValueError("Only angles between 0 and 180 degrees are allowed")
+        wait = self.travel_time(angle)
+        if wait:
+            self.pwm.ChangeDutyCycle(self.duty_cycle(angle))
+            time.sleep(wait)
+            #no pulses while idle, so the servo does not jitter
+            self.pwm.ChangeDutyCycle(0)
+            self.angle = angle
+        return wait
+
+    def stop(self):
+        self.pwm.stop()
+
+SCAN_ORDERS = ("grouped", "led")
+
+def scan_steps(sampler_angles, polarizer_angles, leds, order="grouped"):
+    #(sampler, polarizer, led) in capture order, led None is the background frame
+    #grouped takes every LED at one polarizer angle before turning the polarizer, led turns the polarizer for every LED
+    #the inner sequences are reversed after every pass, so the motors only step to the closest position
+    assert order in SCAN_ORDERS
+    polarizers = list(polarizer_angles)
+    targets = [None] + list(leds)
+    steps = []
+    for sampler in sampler_angles:
+        if order == "grouped":
+            for polarizer in polarizers:
+                steps += [(sampler, polarizer, led) for led in targets]
+                targets.reverse()
+            polarizers.reverse()
+        else:
+            for led in targets:
+                steps += [(sampler, polarizer, led) for polarizer in polarizers]
+                polarizers.reverse()
+            targets.reverse()
+    return steps
+
+class ScanPlanner:
+    #estimates how long a capture order takes and picks the fastest one
+    #a servo move takes move_time or seconds_per_degree of travel if longer, settle_time once before
+    #each capture that follows a move or a LED change
+    def __init__(self, led_angles, move_time=SERVO_MIN_WAIT, seconds_per_degree=SERVO_SECONDS_PER_DEGREE, settle_time=1.0, capture_time=0.5, startup_time=7.0):
+        self.led_angles = led_angles
+        self.move_time = move_time
+        self.seconds_per_degree = seconds_per_degree
+        self.settle_time = settle_time
+        self.capture_time = capture_time
+        self.startup_time = startup_time
+
+    def move_cost(self, start, end):
+        if start == end:
+            return 0.0
+        #unknown starting positions count as a full turn
+        distance = 180.0 if start is None else abs(end - start)
+        return max(self.move_time, distance * self.seconds_per_degree)
+
+    def duration(self, steps):
+        total = self.startup_time
+        sampler = polarizer = led_angle = lit = None
+        for step_sampler, step_polarizer, led in steps:
+            step_led_angle = led_angle if led is None else self.led_angles[led]
+            moves = (self.move_cost(sampler, step_sampler) + self.move_cost(polarizer, step_polarizer)
+                     + self.move_cost(led_angle, step_led_angle))
+            if moves or led != lit:
+                total += moves + self.settle_time
+            total += self.capture_time
+            sampler, polarizer, led_angle, lit = step_sampler, step_polarizer, step_led_angle, led
+        return total
+
+    def plan(self, sampler_angles, polarizer_angles, leds):
+        #returns the order, its steps and the estimated seconds
+        plans = [(order, scan_steps(sampler_angles, polarizer_angles, leds, order)) for order in SCAN_ORDERS]
+        return min(((order, steps, self.duration(steps)) for order, steps in plans), key = lambda plan: plan[2])
+
+def scan_folders(measurement_folder, sampler_angles, polarizer_angles):
+    #Copol_Sampler_ and Depol_Sampler_ folder of every (sampler, polarizer) pair, as the analysis expects them
+    folders = {}
+    for sampler in sampler_angles:
+        for polarizer, polarization in zip(polarizer_angles, ["Copol", "Depol"]):
+            folders[(sampler, polarizer)] = os.path.join(measurement_folder, f"{polarization}_Sampler_{sampler}")
+            os.makedirs(folders[(sampler, polarizer)], exist_ok = True)
+    return folders
+
+def run_scan(steps, folders, servos, leds, capture, settle, wavelengths, led_angles, extension=".jpg", max_settle=1.0):
+    #takes the planned steps: servos maps "Sampler", "Polarizer" and "LED Motor" to ServoController,
+    #leds switches the LEDs, capture(path) takes a frame and settle(max_wait) waits for the scene
+    lit = None
+    try:
+        for sampler, polarizer, led in steps:
+            changed = False
+            if lit is not None and led != lit:
+                #turn of led
+                leds.off(lit)
+                print("Led apagado")
+                changed = True
+
+            #move motors, the leds motor stays where it is for the background
+            for motor, angle in [("Sampler", sampler), ("Polarizer", polarizer),
+                                 ("LED Motor", None if led is None else led_angles[led])]:
+                if angle is not None and servos[motor].move(angle):
+                    changed = True
+
+            if led is not None and led != lit:
+                #turn on led
+                leds.on(led)
+                print("Led encendido")
+                changed = True
+            lit = led
+
+            #wait once for everything that changed
+            if changed:
+                settle(max_settle)
+
+            name = "background" if led is None else f"{wavelengths[led]}"
+            capture(os.path.join(folders[(sampler, polarizer)], name + extension))
+            print(f"{os.path.basename(folders[(sampler, polarizer)])} {name} taken")
+    finally:
+        if lit is not None:
+            leds.off(lit)
+            print("Led apagado")
+    return len(steps)
@@ -0,0 +1,314 @@
+import os
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+#I2C address of the LED board and the register of every LED, from 445 to 980 nm
+LED_ADDRESS = 0x08
+LED_REGISTERS = [2,3,4,5,6,7,8,9,10,11,12,14,15,16,17]
+
+class LedController:
+    #switches the LEDs through the I2C board, 0 turns a LED on and 1 turns it off
+    def __init__(self, bus, address=LED_ADDRESS, registers=LED_REGISTERS):
+        self.bus = bus
+        self.address = address
+        self.registers = registers
+
+    def on(self, led):
+        self.bus.write_i2c_block_data(self.address, self.registers[led], [0])
+
+    def off(self, led):
+        self.bus.write_i2c_block_data(self.address, self.registers[led], [1])
+
+class Hardware:
+    #the Raspberry Pi devices, imported here so the acquisition code also runs where they are missing
+    simulated = False
+    def __init__(self, bus_number=1):
+        import RPi.GPIO
+        import smbus
+        from picamera2 import Picamera2, Preview
+        self.gpio = RPi.GPIO
+        self.bus = smbus.SMBus(bus_number)
+        self.camera = Picamera2()
+        self.Preview = Preview
+
+    def assign_pins(self, pins):
+        pass
+
+#--------------------------------------------------
+# simulated devices, with the delays of the real ones
+
+class SimulatedWorld:
+    #servo angles, LED states and the scene the simulated camera looks at
+    def __init__(self, seed=0, seconds_per_degree=0.4 / 180, led_rise_time=0.03, noise=2.0):
+        self.rng = np.random.default_rng(seed)
+        self.seconds_per_degree = seconds_per_degree
+        self.led_rise_time = led_rise_time
+        self.noise = noise
+        self.lock = threading.Lock()
+        self.servos = {} # pin -> (start angle, target angle, start time)
+        self.leds = {} # register -> time it was turned on
+        self.roles = {} # "Sampler", "Polarizer" and "LED Motor" -> pin
+        #three round samples with their own spectra and depolarization on a dark background
+        leds = len(LED_REGISTERS)
+        self.samples = [(-0.5, 0.0, 0.3), (0.0, 0.3, 0.25), (0.5, -0.2, 0.3)]
+        self.spectra = np.array([np.full(leds, 0.05),
+                                 np.linspace(0.2, 0.9, leds),
+                                 np.linspace(0.9, 0.2, leds),
+                                 0.5 + 0.3 * np.sin(np.linspace(0, 3 * np.pi, leds))], dtype = np.float32)
+        self.depolarization = np.array([0.9, 0.2, 0.5, 0.7], dtype = np.float32)
+        self.led_power = (0.6 + 0.4 * self.rng.random(leds)).astype(np.float32)
+        self.scenes = {}
+
+    def set_servo(self, pin, angle):
+        now = time.perf_counter()
+        with self.lock:
+            start = self.servo_angle(pin, now)
+            self.servos[pin] = (start, angle, now)
+
+    def servo_angle(self, pin, t):
+        if pin not in self.servos:
+            return 0.0
+        start, target, start_time = self.servos[pin]
+        travel = (t - start_time) / self.seconds_per_degree
+        if travel >= abs(target - start):
+            return target
+        return start + np.sign(target - start) * travel
+
+    def angle(self, role, t):
+        return self.servo_angle(self.roles.get(role), t)
+
+    def set_led(self, register, on):
+        with self.lock:
+            if on:
+                self.leds.setdefault(register, time.perf_counter())
+            else:
+                self.leds.pop(register, None)
+
+    def scene(self, size):
+        #label of every pixel and the vignetting, cached for each frame size
+        if size not in self.scenes:
+            width, height = size
+            x, y = np.meshgrid(np.linspace(-1, 1, width, dtype = np.float32), np.linspace(-1, 1, height, dtype = np.float32))
+            labels = np.zeros((height, width), dtype = np.uint8)
+            for i, (cx, cy, radius) in enumerate(self.samples):
+                labels[(x - cx)**2 + (y - cy)**2 < radius**2] = i + 1
+            self.scenes[size] = (labels, 1 - 0.3 * (x**2 + y**2))
+        return self.scenes[size]
+
+    def frame(self, size, t, exposure_time=100000, analogue_gain=1.0, bits=8):
+        #luminance of a frame that ends exposing at t, in counts of a bits deep sensor
+        labels, vignetting = self.scene(size)
+        with self.lock:
+            leds = dict(self.leds)
+            polarizer = np.radians(self.angle("Polarizer", t))
+            sampler = np.radians(self.angle("Sampler", t))
+            led_motor = self.angle("LED Motor", t)
+        reflectance = np.zeros(len(self.spectra), dtype = np.float32)
+        for register, on_time in leds.items():
+            led = LED_REGISTERS.index(register)
+            rise = 1 - np.exp(-max(t - on_time, 0) / self.led_rise_time)
+            #the LED only lights the sample when the LED motor points it there
+            alignment = np.exp(-((led_motor - 12 * led) / 4)**2)
+            reflectance += self.led_power[led] * rise * alignment * self.spectra[:, led]
+        #copolarized light follows Malus law, depolarized light passes half
+        polarized = reflectance * ((1 - self.depolarization) * np.cos(polarizer)**2 + self.depolarization / 2)
+        signal = 200 * exposure_time / 100000 * analogue_gain * np.cos(sampler / 2) * polarized
+        frame = 6 + signal[labels] * vignetting
+        frame += self.noise * self.rng.standard_normal(frame.shape, dtype = np.float32)
+        full_scale = 2**bits - 1
+        return np.clip(frame * (full_scale / 255), 0, full_scale).astype(np.uint8 if bits <= 8 else np.uint16)
+
+class SimulatedPWM:
+    def __init__(self, gpio, pin, frequency):
+        self.gpio = gpio
+        self.pin = pin
+        self.frequency = frequency
+
+    def start(self, duty_cycle):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle):
+        #0 stops the pulses and the servo holds its position
+        if duty_cycle:
+            self.gpio.world.set_servo(self.pin, (duty_cycle - 2) * 18)
+
+    def stop(self):
+        self.gpio.channels.discard(self.pin)
+
+class SimulatedGPIO:
+    #the part of RPi.GPIO the console uses, with the same errors for misused channels
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    def __init__(self, world):
+        self.world = world
+        self.outputs = set()
+        self.channels = set()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction):
+        if direction == self.OUT:
+            self.outputs.add(pin)
+
+    def PWM(self, pin, frequency):
+        if pin not in self.outputs:
+            raise RuntimeError("You must setup() the GPIO channel as an output first")
+        if pin in self.channels:
+            raise RuntimeError("A PWM object already exists for this GPIO channel")
+        self.channels.add(pin)
+        return SimulatedPWM(self, pin, frequency)
+
+    def cleanup(self):
+        self.outputs.clear()
+        self.channels.clear()
+
+class SimulatedBus:
+    #an SMBus that switches the simulated LEDs, a block write takes about half a millisecond
+    def __init__(self, world):
+        self.world = world
+
+    def write_i2c_block_data(self, address, register, data):
+        time.sleep(0.0005)
+        if address == LED_ADDRESS and register in LED_REGISTERS:
+            self.world.set_led(register, data[0] == 0)
+
+class SimulatedPreview:
+    NULL = "NULL"
+    DRM = "DRM"
+    QT = "QT"
+    QTGL = "QTGL"
+
+#raw sizes of the HQ camera sensor modes
+SENSOR_MODES = [(1332, 990), (2028, 1080), (2028, 1520), (4056, 3040)]
+
+class SimulatedCamera:
+    #the part of Picamera2 the console uses. frames come at the sensor frame rate, and starting the
+    #camera, switching modes and writing files take about as long as on the Pi. like on the Pi, the raw
+    #stream snaps to a sensor mode and its rows are padded to a stride
+    def __init__(self, world, start_time=0.3, switch_time=0.25):
+        self.world = world
+        self.start_time = start_time
+        self.switch_time = switch_time
+        self.config = self.create_preview_configuration()
+        self.controls = {"ExposureTime":100000, "AnalogueGain":1.0}
+        self.started = None
+        self.preview = None
+
+    def create_configuration(self, use_case, main, lores, raw, main_format):
+        main = dict({"size":(640, 480), "format":main_format}, **(main or {}))
+        config = {"use_case":use_case, "main":main, "lores":None, "raw":None}
+        if lores is not None:
+            config["lores"] = dict({"format":"YUV420"}, **lores)
+        if raw is not None:
+            config["raw"] = dict({"format":"SRGGB12", "size":tuple(2 * x for x in main["size"])}, **raw)
+        return config
+
+    def create_preview_configuration(self, main=None, lores=None, raw=None, **kwargs):
+        return self.create_configuration("preview", main, lores, raw, "XBGR8888")
+
+    def create_still_configuration(self, main=None, lores=None, raw=None, **kwargs):
+        return self.create_configuration("still", main, lores, raw, "BGR888")
+
+    def camera_configuration(self):
+        return self.config
+
+    def apply(self, config):
+        #the configuration the camera really runs, the raw size becomes the smallest sensor mode that covers it
+        config = dict(config)
+        if config["raw"] is not None:
+            width, height = config["raw"]["size"]
+            modes = [mode for mode in SENSOR_MODES if mode[0] >= width and mode[1] >= height] or SENSOR_MODES[-1:]
+            config["raw"] = dict(config["raw"], size = modes[0])
+        return config
+
+    def configure(self, config):
+        self.config = self.apply(config)
+
+    def set_controls(self, controls):
+        self.controls.update(controls)
+
+    def start_preview(self, preview=None):
+        self.preview = preview
+
+    def stop_preview(self):
+        self.preview = None
+
+    def start(self):
+        time.sleep(self.start_time)
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.started = None
+
+    def frame_period(self):
+        #the exposure, or the fastest frame rate of the sensor mode
+        return max(self.controls["ExposureTime"] / 1e6, 1 / 30 if self.config["use_case"] == "preview" else 1 / 10)
+
+    def next_frame(self, size, bits=8):
+        if self.started is None:
+            raise RuntimeError("Camera must be started before capturing")
+        period = self.frame_period()
+        now = time.perf_counter()
+        t = self.started + period * (np.floor((now - self.started) / period) + 1)
+        time.sleep(t - now)
+        return self.world.frame(size, t, self.controls["ExposureTime"], self.controls["AnalogueGain"], bits)
+
+    def capture_array(self, name="main"):
+        stream = self.config[name]
+        if name == "raw":
+            #unpacked Bayer pixels as bytes with rows padded to 64 bytes, every colour sees the same grey scene
+            frame = self.next_frame(tuple(stream["size"]), int(stream["format"][-2:])).view(np.uint8)
+            stride = -(-frame.shape[1] // 64) * 64
+            return np.pad(frame, ((0, 0), (0, stride - frame.shape[1])))
+        frame = self.next_frame(tuple(stream["size"]))
+        if stream["format"] == "YUV420":
+            #Y plane followed by the subsampled U and V planes
+            return np.concatenate([frame, np.full((frame.shape[0] // 2, frame.shape[1]), 128, dtype = np.uint8)])
+        if stream["format"] == "XBGR8888":
+            return np.dstack([frame, frame, frame, np.full(frame.shape, 255, dtype = np.uint8)])
+        return np.dstack([frame, frame, frame])
+
+    def switch_mode_and_capture_array(self, config, name="main"):
+        previous = self.config
+        time.sleep(self.switch_time)
+        self.config = self.apply(config)
+        array = self.capture_array(name)
+        time.sleep(self.switch_time)
+        self.config = previous
+        return array
+
+    def switch_mode_and_capture_file(self, config, path):
+        previous = self.config
+        time.sleep(self.switch_time)
+        self.config = self.apply(config)
+        array = self.capture_array("main")
+        if path.endswith(".npy"):
+            np.save(path, array)
+        else:
+            Image.fromarray(array).save(path, quality = 90)
+        time.sleep(self.switch_time)
+        self.config = previous
+
+class SimulatedHardware:
+    simulated = True
+    def __init__(self, seed=0):
+        self.world = SimulatedWorld(seed)
+        self.gpio = SimulatedGPIO(self.world)
+        self.bus = SimulatedBus(self.world)
+        self.camera = SimulatedCamera(self.world)
+        self.Preview = SimulatedPreview
+
+    def assign_pins(self, pins):
+        #lets the camera know which servo turns what
+        self.world.roles = dict(pins)
+
+def open_hardware(simulated=None):
+    #simulated devices when asked for, or when HYPERPI_SIMULATE is set
+    if simulated is None:
+        simulated = os.environ.get("HYPERPI_SIMULATE", "") not in ("", "0")
+    return SimulatedHardware() if simulated else Hardware()
@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from HyperPi_Acquisition import (FrameWriter, ScanPlanner, ServoController, SettleDetector, run_scan, scan_folders,
+                                 RAW_FORMAT, raw_luminance)
+from HyperPi_Hardware import LedController, SimulatedHardware
+
+LEDs = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 800, 850, 880, 940, 980]
+PINS = {"Sampler":40, "Polarizer":38, "LED Motor":36}
+
+def simulated_scan(folder_path, width=800, height=600, sampler_angles=(0.0,), capture_to_memory=True,
+                   adaptive_settle=True, raw_frames=False, exposure_time=100000, seed=0):
+    #runs the scan CameraApp.measure runs, on simulated devices, and returns its timings
+    hardware = SimulatedHardware(seed)
+    hardware.gpio.setmode(hardware.gpio.BOARD)
+    servos = {motor:ServoController(hardware.gpio, pin) for motor, pin in PINS.items()}
+    hardware.assign_pins(PINS)
+    leds = LedController(hardware.bus)
+    camera = hardware.camera
+    polarizer_angles = [0.0, 90.0]
+    led_angles = [12*led for led in range(len(LEDs))]
+
+    planner = ScanPlanner(led_angles, capture_time = 0.1 if capture_to_memory else 0.5)
+    order, steps, estimate = planner.plan(list(sampler_angles), polarizer_angles, range(len(LEDs)))
+
+    start = time.perf_counter()
+    lores = {"size":(min(320, width), min(240, height)), "format":"YUV420"}
+    preview_config = camera.create_preview_configuration({"size":(width, height)}, lores = lores)
+    raw = {"format":RAW_FORMAT, "size":(2 * width, 2 * height)} if raw_frames else None
+    still_config = camera.create_still_configuration({"size":(width, height)}, lores = lores, raw = raw)
+    extension = ".npy" if raw_frames else ".jpg"
+    if raw_frames:
+        #the size of the sensor mode the raw stream really gets
+        camera.configure(still_config)
+        raw_width, raw_height = camera.camera_configuration()["raw"]["size"]
+        width, height = raw_width // 2, raw_height // 2
+        convert = lambda array: raw_luminance(array, raw_width)
+    settle_detector = SettleDetector(lambda: camera.capture_array("lores")[:lores["size"][1]])
+    def settle(max_wait):
+        if adaptive_settle:
+            settle_detector.wait(max_wait)
+        else:
+            time.sleep(max_wait)
+    frame_writer = FrameWriter()
+    def capture(path):
+        if raw_frames and capture_to_memory:
+            frame_writer.submit(camera.capture_array("raw"), path, convert)
+        elif raw_frames:
+            np.save(path, convert(camera.switch_mode_and_capture_array(still_config, "raw")))
+            time.sleep(0.5)
+        elif capture_to_memory:
+            frame_writer.submit(camera.capture_array("main"), path)
+        else:
+            camera.switch_mode_and_capture_file(still_config, path)
+            time.sleep(0.5)
+
+    camera.configure(still_config if capture_to_memory else preview_config)
+    camera.set_controls({"ExposureTime":exposure_time, "AnalogueGain":1.0})
+    camera.start()
+    settle(7)
+    os.makedirs(folder_path, exist_ok = True)
+    with open(os.path.join(folder_path, "Controls Setting.txt"), 'w') as file:
+        for control, value, type_var in [("Width", width, "Int"), ("Height", height, "Int"),
+                                          ("ExposureTime", exposure_time, "Int"), ("AnalogueGain", 1.0, "Float")]:
+            file.write(f"{control}\t{value}\t{type_var} \n")
+    folders = scan_folders(folder_path, list(sampler_angles), polarizer_angles)
+    frames = run_scan(steps, folders, servos, leds, capture, settle, LEDs, led_angles, extension)
+    camera.stop()
+    written = frame_writer.close() if capture_to_memory else frames
+    seconds = time.perf_counter() - start
+
+    for servo in servos.values():
+        servo.stop()
+    hardware.gpio.cleanup()
+    return {"order":order,
+            "frames":frames,
+            "written":written,
+            "estimated_seconds":estimate,
+            "seconds":seconds,
+            "frames_per_second":frames / seconds,
+            "settle_seconds":settle_detector.waited if adaptive_settle else None,
+            "settle_timeouts":settle_detector.timeouts if adaptive_settle else None}
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark a HyperPi scan on simulated camera, servos and LEDs.")
+    parser.add_argument("--width", type = int, default = 800)
+    parser.add_argument("--height", type = int, default = 600)
+    parser.add_argument("--samplers", type = int, default = 1, help = "Number of sampler angles")
+    parser.add_argument("--exposure", type = int, default = 100000, help = "Exposure time in microseconds")
+    parser.add_argument("--file-mode", action = "store_true", help = "Capture with a mode switch to a file, as before")
+    parser.add_argument("--raw", action = "store_true", help = "Save 16 bit luminance from the raw frames as .npy")
+    parser.add_argument("--fixed-sleeps", action = "store_true", help = "Wait the full delays instead of detecting the settle")
+    parser.add_argument("--workdir", default = None, help = "Folder for the measurement (a temporary folder by default)")
+    parser.add_argument("--json", default = None, help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = "hyperpi_scan_")
+    sampler_angles = [float(10 * i) for i in range(args.samplers)]
+    print(f"Simulated scan at {workdir}: {args.width}x{args.height}, {args.samplers} sampler angles, "
+          f"{'file' if args.file_mode else 'memory'} capture, {'fixed' if args.fixed_sleeps else 'adaptive'} settle, "
+          f"{'raw .npy' if args.raw else '.jpg'} frames\n")
+    try:
+        result = simulated_scan(os.path.join(workdir, "Measurement_simulated"), args.width, args.height, sampler_angles,
+                                not args.file_mode, not args.fixed_sleeps, args.raw, exposure_time = args.exposure)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    print(f"\n{result['frames']} frames in {result['order']} order, {result['written']} written")
+    print(f"Scan took {result['seconds']:.1f} s, estimated at most {result['estimated_seconds']:.1f} s, "
+          f"{result['frames_per_second']:.2f} frames/s")
+    if result["settle_seconds"] is not None:
+        print(f"Settling took {result['settle_seconds']:.1f} s, {result['settle_timeouts']} waits reached their limit")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({"width":args.width, "height":args.height, "samplers":args.samplers,
+                       "file_mode":args.file_mode, "fixed_sleeps":args.fixed_sleeps, "raw":args.raw, "result":result}, file, indent = 1)
+        print(f"\nResults saved at {args.json}")
+
+if __name__ == "__main__":
+    main()
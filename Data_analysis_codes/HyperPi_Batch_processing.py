@@ -0,0 +1,114 @@
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from data_analysis_functions import *
+
+LEDs = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 800, 850, 880, 940, 980]
+
+def find_measurements(patterns):
+    folders = []
+    for pattern in patterns:
+        for folder in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(folder) and any(sub.startswith("Copol_Sampler_") for sub in os.listdir(folder)):
+                if folder not in folders:
+                    folders.append(folder)
+            else:
+                print(f"Skipping {folder}: no Copol_Sampler_ folders found")
+    return folders
+
+def process_measurement(folder_path, reference, flatfield_shape, output_folder, extension, threads, memmap, products=False,
+                        cache_dir=None):
+    start = time.time()
+    statistics = CubeStatistics()
+    #the results already go to output_folder, so the cube is only cached when a cache folder is given
+    hyperpi_data, folder_path, copol_folders = read_hyperpi_data(reference, flatfield_shape, extension,
+                                                                 workers = threads, memmap = memmap,
+                                                                 use_cache = cache_dir is not None,
+                                                                 cache_dir = cache_dir,
+                                                                 folder_path = folder_path, statistics = statistics)
+    angles = folder_angles(copol_folders)
+
+    save_folder = os.path.join(output_folder, os.path.basename(os.path.normpath(folder_path)))
+    os.makedirs(save_folder, exist_ok = True)
+
+    #corrected cube as (Height, Width, LED, sampler, polarization)
+    np.save(os.path.join(save_folder, "hyperpi_data.npy"), hyperpi_data)
+    with open(os.path.join(save_folder, "hyperpi_data.json"), 'w') as file:
+        json.dump({"measurement":folder_path,
+                   "shape":list(hyperpi_data.shape),
+                   "leds":LEDs,
+                   "angles":angles,
+                   "polarizations":["Copol", "Depol"],
+                   "products":list(POLARIZATION_PRODUCTS) if products else []}, file, indent = 1)
+
+    if products:
+        #(Height, Width, LED, sampler) maps written straight into .npy files
+        shape = hyperpi_data.shape[:4]
+        out = {name:np.lib.format.open_memmap(os.path.join(save_folder, f"{name}.npy"), mode = "w+", dtype = np.float32, shape = shape)
+               for name in POLARIZATION_PRODUCTS}
+        PolarizationProducts(hyperpi_data).compute_all(out)
+        for product in out.values():
+            product.flush()
+
+    #per-slice statistics, and the mean intensity of every LED, angle and polarization as shown by polar_intensities
+    statistics.ensure(hyperpi_data)
+    statistics.save(os.path.join(save_folder, "hyperpi_stats.npz"))
+    for warning in statistics.quality_report(LEDs, angles):
+        print(f"Warning, {os.path.basename(os.path.normpath(folder_path))} {warning}")
+    means = statistics.mean
+    pd.DataFrame({"Wavelength [nm]":np.repeat(LEDs, len(angles)),
+                  "Angle [deg]":np.tile(angles, len(LEDs)),
+                  "Copol Intensity":means[:,:,0].flatten(),
+                  "Depol Intensity":means[:,:,1].flatten()}).to_csv(os.path.join(save_folder, "intensities.csv"), index = False)
+
+    return save_folder, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description = "Process HyperPi measurement folders without the GUI.")
+    parser.add_argument("measurements", nargs = "+",
+                        help = "Measurement_ folders or glob patterns, e.g. 'Results/Measurement_2024*'")
+    parser.add_argument("--reference", required = True, help = "Reference measurement folder")
+    parser.add_argument("--reflectance", type = float, default = 0.7, help = "Reflectance of the reference target")
+    parser.add_argument("--output", required = True, help = "Folder where the corrected cubes and products are written")
+    parser.add_argument("--extension", default = None,
+                        help = "Extension of the frames, detected from the background frames by default")
+    parser.add_argument("--jobs", type = int, default = os.cpu_count() or 1, help = "Measurements processed at the same time")
+    parser.add_argument("--threads", type = int, default = 1, help = "Decoding threads for each measurement")
+    parser.add_argument("--memmap", action = "store_true", help = "Keep each cube in a file on disk instead of RAM")
+    parser.add_argument("--cache-dir", default = None,
+                        help = "Also cache the corrected cubes in this folder, so later runs load them straight away")
+    parser.add_argument("--products", action = "store_true",
+                        help = "Also write the copol - depol difference, depolarization ratio and degree of linear polarization")
+    args = parser.parse_args()
+
+    folders = find_measurements(args.measurements)
+    if not folders:
+        parser.error("No measurement folders found")
+
+    reference, flatfield_shape, reference_folder = read_reference(args.reflectance, args.extension,
+                                                                  folder_path = args.reference)
+    print(f"Reference read from {reference_folder}")
+
+    start = time.time()
+    failed = []
+    with ProcessPoolExecutor(max_workers = args.jobs) as executor:
+        jobs = {executor.submit(process_measurement, folder, reference, flatfield_shape, args.output,
+                                args.extension, args.threads, args.memmap, args.products, args.cache_dir): folder for folder in folders}
+        for i, job in enumerate(as_completed(jobs)):
+            try:
+                save_folder, seconds = job.result()
+                print(f"[{i + 1}/{len(folders)}] {jobs[job]} -> {save_folder} ({seconds:.1f} s)")
+            except Exception as e:
+                failed.append(jobs[job])
+                print(f"[{i + 1}/{len(folders)}] Error while processing {jobs[job]}: {str(e)}")
+
+    print(f"\n{len(folders) - len(failed)} of {len(folders)} measurements processed in {time.time() - start:.1f} s")
+    if failed:
+        print("Failed:", *failed, sep = "\n")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
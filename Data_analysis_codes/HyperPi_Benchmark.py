@@ -0,0 +1,179 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from data_analysis_functions import *
+
+LEDs = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 800, 850, 880, 940, 980]
+
+def write_controls_file(folder_path, width, height, exposure_time=100000, analogue_gain=1.0):
+    #same layout CameraApp.measure writes: name, value and type separated by tabs
+    with open(os.path.join(folder_path, "Controls Setting.txt"), 'w') as file:
+        for control, value, type_var in [("Width", width, "Int"),
+                                          ("Height", height, "Int"),
+                                          ("ExposureTime", exposure_time, "Int"),
+                                          ("AnalogueGain", analogue_gain, "Float"),
+                                          ("AwbEnable", False, "Bool"),
+                                          ("LensPosition", 1.0, "Float")]:
+            file.write(f"{control}\t{value}\t{type_var} \n")
+
+def make_synthetic_measurement(folder_path, width=800, height=600, angles=(0.0,), extension=".tiff", reference=False, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder_path, exist_ok = True)
+    write_controls_file(folder_path, width, height)
+
+    x, y = np.meshgrid(np.linspace(-1, 1, width), np.linspace(-1, 1, height))
+    vignetting = 1 - 0.3 * (x**2 + y**2)
+    led_power = 0.6 + 0.4 * rng.random(len(LEDs))
+    if reference:
+        #flat white target
+        reflectance = np.ones((height, width, len(LEDs))) * 0.7
+    else:
+        #three round samples with different spectra on a dark background
+        reflectance = np.full((height, width, len(LEDs)), 0.05)
+        for cx, cy, spectrum in [(-0.5, 0.0, np.linspace(0.2, 0.9, len(LEDs))),
+                                 (0.0, 0.3, np.linspace(0.9, 0.2, len(LEDs))),
+                                 (0.5, -0.2, 0.5 + 0.3 * np.sin(np.linspace(0, 3 * np.pi, len(LEDs))))]:
+            reflectance[(x - cx)**2 + (y - cy)**2 < 0.1] = spectrum
+
+    for angle in angles:
+        for polarization, pol_factor in [("Copol", 1.0), ("Depol", 0.4)]:
+            folder = os.path.join(folder_path, f"{polarization}_Sampler_{float(angle)}")
+            os.makedirs(folder, exist_ok = True)
+            background = rng.normal(8, 2, (height, width))
+            save_frame(background, os.path.join(folder, "background" + extension))
+            for led_in, wavelength in enumerate(LEDs):
+                signal = 200 * vignetting * led_power[led_in] * reflectance[:, :, led_in] * pol_factor * np.cos(np.radians(angle) / 2)
+                frame = background + signal + rng.normal(0, 2, (height, width))
+                save_frame(frame, os.path.join(folder, f"{wavelength}" + extension))
+    return folder_path
+
+def save_frame(frame, path):
+    #.npy frames hold 16 bit luminance, like the raw frames of the console
+    if path.endswith(".npy"):
+        np.save(path, np.clip(frame * 257, 0, 65535).astype(np.uint16))
+    else:
+        Image.fromarray(np.clip(frame, 0, 255).astype(np.uint8)).save(path)
+
+def measure(results, stage, function, frames=0, frame_bytes=0, repeats=1):
+    times = []
+    tracemalloc.start()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            output = function()
+            times.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+    except Exception as e:
+        tracemalloc.stop()
+        print(f"{stage:<34} failed: {str(e)}")
+        results.append({"stage":stage, "error":str(e)})
+        return None
+    tracemalloc.stop()
+
+    seconds = min(times)
+    result = {"stage":stage,
+              "seconds":seconds,
+              "frames_per_second":frames / seconds if frames else None,
+              "MB_per_second":frame_bytes / seconds / 2**20 if frame_bytes else None,
+              "peak_MB":peak / 2**20}
+    results.append(result)
+    print(f"{stage:<34} {seconds:9.4f} s"
+          + (f" {result['frames_per_second']:9.1f} frames/s" if frames else " " * 19)
+          + (f" {result['MB_per_second']:9.1f} MB/s" if frame_bytes else " " * 15)
+          + f" {result['peak_MB']:9.1f} MB peak")
+    return output
+
+def benchmark_viewers(results, hyperpi_data, angles, save_folder, repeats):
+    import tkinter as tk
+    import HyperPi_Data_analysis_Console as console
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Viewers skipped, no display available: {str(e)}")
+        return
+    root.withdraw()
+    #dialogs are answered with the benchmark folder
+    console.filedialog.askdirectory = lambda **kwargs: save_folder
+    try:
+        mono = console.Monochromatic_image(tk.Toplevel(root), hyperpi_data, LEDs, angles)
+        def flip_leds():
+            for led in LEDs:
+                mono.current_led.set(led)
+        measure(results, "Monochromatic_image 15 LEDs", flip_leds, repeats = repeats)
+
+        fci = console.FalseColorImage(tk.Toplevel(root), hyperpi_data, LEDs, angles)
+        measure(results, "FalseColorImage redraw", fci.update_image, repeats = repeats)
+
+        elipso = console.ElipsoImage(tk.Toplevel(root), hyperpi_data, LEDs, angles)
+        measure(results, "ElipsoImage redraw", elipso.update_image, repeats = repeats)
+
+        make_gif = console.MakeGif(tk.Toplevel(root), hyperpi_data, LEDs, angles)
+        measure(results, "MakeGif wavelength gif", make_gif.make_wave_gif)
+        make_gif = console.MakeGif(tk.Toplevel(root), hyperpi_data, LEDs, angles)
+        measure(results, "MakeGif angle gif", make_gif.make_angle_gif)
+    finally:
+        root.destroy()
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the HyperPi analysis pipeline on synthetic measurements.")
+    parser.add_argument("--width", type = int, default = 800)
+    parser.add_argument("--height", type = int, default = 600)
+    parser.add_argument("--samplers", type = int, default = 3, help = "Number of sampler angles")
+    parser.add_argument("--extension", default = ".tiff", help = "Frame format, e.g. .tiff, .png, .jpg or .npy")
+    parser.add_argument("--repeats", type = int, default = 3, help = "Repetitions of each timed stage, the fastest is reported")
+    parser.add_argument("--workdir", default = None, help = "Folder for the synthetic data (a temporary folder by default)")
+    parser.add_argument("--no-viewers", action = "store_true", help = "Skip the Tk viewer and GIF stages")
+    parser.add_argument("--json", default = None, help = "Write the results to this JSON file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = "hyperpi_benchmark_")
+    angles = [float(angle) for angle in np.linspace(0, 10 * (args.samplers - 1), args.samplers)]
+    frames = len(LEDs) * len(angles) * 2
+    frame_bytes = args.width * args.height
+    results = []
+    print(f"Synthetic data at {workdir}: {args.width}x{args.height}, {args.samplers} sampler angles, {args.extension}\n")
+
+    try:
+        reference_folder = measure(results, "generate reference",
+                                   lambda: make_synthetic_measurement(os.path.join(workdir, "Reference"), args.width, args.height,
+                                                                      [0.0], args.extension, reference = True))
+        measurement_folder = measure(results, "generate measurement",
+                                     lambda: make_synthetic_measurement(os.path.join(workdir, "Measurement_benchmark"), args.width,
+                                                                        args.height, angles, args.extension, seed = 1))
+
+        reference, flatfield_shape, _ = measure(results, "read_reference",
+                                                lambda: read_reference(0.7, args.extension, calibration_store = None,
+                                                                       folder_path = reference_folder),
+                                                len(LEDs), len(LEDs) * frame_bytes, args.repeats)
+        mean_image = np.random.default_rng(2).random((args.height, args.width))
+        measure(results, "flat-field fit", lambda: regression_2d_3rd_order(mean_image), repeats = args.repeats)
+
+        load = lambda **kwargs: read_hyperpi_data(reference, flatfield_shape, args.extension,
+                                                  folder_path = measurement_folder, **kwargs)
+        hyperpi_data, _, copol_folders = measure(results, "read_hyperpi_data", lambda: load(use_cache = False),
+                                                 frames, frames * frame_bytes, args.repeats)
+        measure(results, "read_hyperpi_data memmap", lambda: load(use_cache = False, memmap = True),
+                frames, frames * frame_bytes, args.repeats)
+        measure(results, "read_hyperpi_data cache write", lambda: load(), frames, frames * frame_bytes)
+        measure(results, "read_hyperpi_data cache hit", lambda: load(), repeats = args.repeats)
+        measure(results, "lazy cube first image", lambda: load(use_cache = False, lazy = True)[0][:, :, 0, 0, 0],
+                1, frame_bytes, args.repeats)
+
+        if not args.no_viewers:
+            benchmark_viewers(results, hyperpi_data, folder_angles(copol_folders), workdir, args.repeats)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({"width":args.width, "height":args.height, "samplers":args.samplers,
+                       "extension":args.extension, "results":results}, file, indent = 1)
+        print(f"\nResults saved at {args.json}")
+
+if __name__ == "__main__":
+    main()
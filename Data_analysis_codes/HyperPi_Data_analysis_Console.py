@@ -3,29 +3,51 @@ from tkinter import filedialog
 import tkinter as tk
 from tkinter import ttk
 import threading
+import queue
 import time
 import os
-from PIL import Image, ImageDraw, ImageFont
-import matplotlib.cm as cm
+from collections import OrderedDict
 import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from data_analysis_functions import *
 
 LEDs = [445, 490, 520, 560, 580, 600, 620, 660, 680, 730, 800, 850, 880, 940, 980]
 
+def show_pyramid_view(ax, img, pyramid):
+    #only the visible part of the level that fits the axes size is handed to matplotlib
+    bbox = ax.get_window_extent()
+    im, extent = pyramid.view(ax.get_xlim(), ax.get_ylim(), (bbox.width, bbox.height))
+    img.set_data(im)
+    img.set_extent(extent)
+
 class Monochromatic_image:
-    def __init__(self,root,data,leds,angles):
+    def __init__(self,root,data,leds,angles,statistics=None):
         self.root = root
         self.data = data
         self.leds = leds
         self.angles = angles
+        self.statistics = statistics if statistics is not None else CubeStatistics()
         self.root.title("Monochromatic image")
 
         #define canvas
         self.fig, self.ax = plt.subplots(figsize = (7,6), ncols=1)
-        self.canvas = FigureCanvasTkAgg(self.fig, master = self.root)
+        self.canvas_frame = tk.Frame(self.root)
+        self.canvas_frame.grid(row = 0, column = 0, columnspan = 3)
+        self.canvas = FigureCanvasTkAgg(self.fig, master = self.canvas_frame)
         self.canvas.draw()
-        self.canvas.get_tk_widget().grid(row = 0, column = 0, columnspan = 3)
+        self.canvas.get_tk_widget().pack()
+        #zoom and pan, the shown level follows the visible region
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.canvas_frame)
+        self.toolbar.update()
+        self.img = None
+        self.ax.callbacks.connect("xlim_changed", lambda ax: self.refresh_view())
+        self.ax.callbacks.connect("ylim_changed", lambda ax: self.refresh_view())
+        self.canvas.mpl_connect("resize_event", lambda event: self.refresh_view())
+        self.background = None
+
+        #pyramids of the square-rooted slices already shown, least recently used first
+        self.display_cache = OrderedDict()
+        self.display_cache_max_bytes = 512 * 2**20
 
         #menubutton for leds
         self.current_led = tk.IntVar(value = self.leds[0])
@@ -56,10 +78,15 @@ class Monochromatic_image:
         tk.Button(self.root, text = "Save image",
                   command = self.save_image).grid(row = 1, column = 2,sticky = "ew", padx = 5, pady = 5)
 
-        #make mask
+        #make mask, every mask drawn is a region of the spectrum
+        self.masks = []
         tk.Button(self.root, text = "Make mask",
                   command = self.monochromatic_mask).grid(row = 2, column = 0,sticky = "ew", padx = 5, pady = 5)
 
+        #clear masks
+        tk.Button(self.root, text = "Clear masks",
+                  command = self.clear_masks).grid(row = 2, column = 2,sticky = "ew", padx = 5, pady = 5)
+
         #show mask
         self.show_mask_btn = tk.Button(self.root, text  =  "Show mask", command = self.show_monochromatic_mask, state = tk.DISABLED)
         self.show_mask_btn.grid(row = 2, column = 1, sticky = "ew", padx = 5, pady = 5)
@@ -76,35 +103,106 @@ class Monochromatic_image:
         tk.Button(self.root, text = "Close window",
                   command = self.root.destroy).grid(row = 3, column = 2,sticky = "ew", padx = 5, pady = 5)
 
+        #auto contrast
+        self.auto_contrast = tk.BooleanVar(value = False)
+        tk.Checkbutton(self.root, text = "Auto contrast", variable = self.auto_contrast,
+                       command = self.update_image).grid(row = 4, column = 0, sticky = "w", padx = 5, pady = 5)
+
         self.update_image()
 
+    def display_slice(self, led_in, sample_in):
+        key = (led_in, sample_in)
+        if key in self.display_cache:
+            self.display_cache.move_to_end(key)
+            return self.display_cache[key]
+
+        pyramid = DisplayPyramid(lambda: np.sqrt(np.maximum(np.asarray(self.data[:,:,led_in,sample_in,0]),0)))
+        #slices of a running measurement can still be empty, so they are not kept
+        if isinstance(self.data, LiveHyperPiCube) and not self.data.complete:
+            return pyramid
+
+        self.display_cache[key] = pyramid
+        #levels are built while viewing, so the size is counted again on every new slice.
+        #Full resolution levels go first, the coarse ones are enough until a zoom
+        for cached in list(self.display_cache.values())[:-1]:
+            if self.display_cache_nbytes() <= self.display_cache_max_bytes:
+                break
+            cached.drop_full_resolution()
+        while self.display_cache_nbytes() > self.display_cache_max_bytes and len(self.display_cache) > 1:
+            self.display_cache.popitem(last = False)
+        return pyramid
+
+    def display_cache_nbytes(self):
+        return sum(cached.nbytes for cached in self.display_cache.values())
+
+    def display_limits(self, led_in, sample_in):
+        #color limits come from the statistics index, the slice is never scanned for them.
+        #Auto contrast spreads the 1st to 99th percentile over the colormap
+        self.statistics.ensure(self.data, led_in, sample_in, 0)
+        index = (led_in, sample_in, 0)
+        if self.auto_contrast.get():
+            low, high = self.statistics.percentile(index, 1), self.statistics.percentile(index, 99)
+        else:
+            low, high = self.statistics.min[index], self.statistics.max[index]
+        return (float(np.sqrt(max(low, 0))), float(np.sqrt(max(high, 0))))
+
     def update_image(self):
         led = int(self.current_led.get())
         sample = float(self.current_angle.get())
         led_in = self.leds.index(led)
         sample_in = self.angles.index(sample)
-        im_xy = self.data[:,:,led_in,sample_in,0]
-        im_xy = np.maximum(im_xy,0)
-        im_for_visualization = np.sqrt(im_xy)
-        
-        try:
-            self.colorbar.remove()
-        except:
-            pass
-        
-        self.ax.clear()
-        self.img = self.ax.imshow(im_for_visualization, cmap='gray')
-        self.colorbar = self.fig.colorbar(self.img, ax = self.ax, location = "right", shrink = 0.7)
-        self.ax.set_xlabel('x (pixel)')
-        self.ax.set_ylabel('y (pixel)')
-        self.ax.set_title(f"Wavelength : {led}     Angle : {sample}")
-        self.canvas.draw()
+        self.pyramid = self.display_slice(led_in, sample_in)
+        clim = self.display_limits(led_in, sample_in)
+        title = f"Wavelength : {led}     Angle : {sample}"
+
+        if self.img is None:
+            #image, title and colorbar are drawn over a cached background on every change
+            self.img = self.ax.imshow(self.pyramid.level(0), cmap='gray', animated = True)
+            self.img.set_clim(*clim)
+            self.colorbar = self.fig.colorbar(self.img, ax = self.ax, location = "right", shrink = 0.7)
+            self.colorbar.ax.set_animated(True)
+            self.ax.set_xlabel('x (pixel)')
+            self.ax.set_ylabel('y (pixel)')
+            self.ax.set_title(title)
+            self.ax.title.set_animated(True)
+            self.ax.set_autoscale_on(False)
+            self.refresh_view()
+            self.canvas.mpl_connect("draw_event", self.on_draw)
+            self.canvas.draw()
+            return
+
+        self.refresh_view()
+        self.img.set_clim(*clim)
+        self.ax.title.set_text(title)
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.fig.bbox)
+
+    def refresh_view(self):
+        if self.img is not None:
+            show_pyramid_view(self.ax, self.img, self.pyramid)
+
+    def draw_animated(self):
+        self.fig.draw_artist(self.img)
+        self.fig.draw_artist(self.ax.title)
+        self.fig.draw_artist(self.colorbar.ax)
+
+    def on_draw(self, event):
+        #savefig draws the animated artists itself
+        if self.canvas.is_saving():
+            return
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
 
     def save_image(self):
         folder_path = filedialog.askdirectory(title = "Select save folder.")
         if folder_path:
             file_path = os.path.join(folder_path, f"Monochromatic_image_{self.current_led.get()}nm_{self.current_angle.get()}d.png")
             self.fig.savefig(file_path, bbox_inches = 'tight')
+            self.canvas.draw()
             print("Image saved at:",file_path,sep='\n')
         
     def monochromatic_mask(self):
@@ -114,9 +212,15 @@ class Monochromatic_image:
         sample_in = self.angles.index(sample)
 
         self.in_mask = make_mask(self.data[:,:,led_in,sample_in,0])
+        self.masks.append(self.in_mask)
         self.show_mask_btn['state'] = tk.NORMAL
         self.make_spectra_btn['state'] = tk.NORMAL
 
+    def clear_masks(self):
+        self.masks = []
+        self.show_mask_btn['state'] = tk.DISABLED
+        self.make_spectra_btn['state'] = tk.DISABLED
+
     def show_monochromatic_mask(self):
         self.in_mask.print_masked_image()
         self.show_mask_btn['state'] = tk.DISABLED
@@ -125,26 +229,36 @@ class Monochromatic_image:
     def get_spectra_image(self):
         sample = float(self.current_angle.get())
         sample_in = self.angles.index(sample)
+        rois = []
+        for i, mask in enumerate(self.masks):
+            if mask.roi is not None:
+                mask.roi.name = f"ROI {i + 1}"
+                rois.append(mask.roi)
+        if not rois:
+            print("Please, finish drawing a mask before getting the spectrum")
+            return
         new_window = tk.Toplevel(self.root)
-        spectra_window = spectrum(new_window, self.data[:,:,:,sample_in,0], self.in_mask.mask, self.leds, sample)
+        spectra_window = spectrum(new_window, self.data, rois, self.leds, self.angles, sample_in)
 
     def get_polar_image(self):
         led = int(self.current_led.get())
         led_in = self.leds.index(led)
+        #mean intensities come from the statistics index instead of averaging every image again
+        self.statistics.ensure(self.data, led_in)
         new_window = tk.Toplevel(self.root)
-        polar_window = polar_intensities(new_window, self.data[:,:,led_in,:,:], self.angles, led)
+        polar_window = polar_intensities(new_window, self.statistics.mean[led_in], self.angles, led)
 
 class polar_intensities:
-    def __init__(self,root,data,angles,led):
+    def __init__(self,root,intensities,angles,led):
         self.root = root
-        self.data = data
         self.angles = angles
         self.led = led
 
         self.root.title(f"Intensity of {self.led}nm LED")
 
-        self.data_copol = np.mean(data[:,:,:,0], axis=(0, 1))
-        self.data_depol = np.mean(data[:,:,:,1], axis=(0, 1))
+        #(sampler, polarization) mean intensities
+        self.data_copol = intensities[:,0]
+        self.data_depol = intensities[:,1]
 
         #define canvas
         self.fig, self.ax = plt.subplots(figsize = (5,5), subplot_kw={'projection': 'polar'})
@@ -184,26 +298,30 @@ class polar_intensities:
         
         
 class spectrum:
-    def __init__(self, root, data, mask, leds, angle):
+    def __init__(self, root, data, rois, leds, angles, angle_in):
         self.root = root
         self.data = data
-        self.mask = mask
+        self.rois = rois
         self.leds = leds
-        self.angle = angle
+        self.angle = angles[angle_in]
 
         self.root.title(f"Spectrum reflectance at {self.angle}° (copolarized)")
 
-        mask_expanded = np.stack([self.mask] * len(self.leds), axis=-1)
-        spectrum_matrix = self.data*mask_expanded
-        spectrum = np.sum(spectrum_matrix, axis=(0, 1)) / np.sum(self.mask)
-        self.spectrum = spectrum*100
+        #every ROI at once, only the copolarized slices at this angle are read
+        means, stds = roi_spectra(self.data, self.rois, samplers = angle_in, pols = 0)
+        self.spectra = means[:,:,0,0]*100
+        self.stds = stds[:,:,0,0]*100
         
         #define canvas
         self.fig, self.ax = plt.subplots(figsize = (6,5), ncols=1)
         self.canvas = FigureCanvasTkAgg(self.fig, master = self.root)
         self.canvas.draw()
         self.canvas.get_tk_widget().grid(row = 0, column = 0, columnspan = 3)
-        self.ax.plot(self.leds, self.spectrum, 'k.-', markersize=12)
+        for roi, roi_spectrum, roi_std in zip(self.rois, self.spectra, self.stds):
+            line, = self.ax.plot(self.leds, roi_spectrum, 'k.-' if len(self.rois) == 1 else '.-', markersize=12, label=roi.name)
+            self.ax.fill_between(self.leds, roi_spectrum - roi_std, roi_spectrum + roi_std, color=line.get_color(), alpha=0.2)
+        if len(self.rois) > 1:
+            self.ax.legend(loc = 'upper right')
         self.ax.set_xlabel('Wavelength [nm]')
         self.ax.set_ylabel('Reflectance [%]')
         self.ax.set_xlim(300, 1020)
@@ -226,9 +344,9 @@ class spectrum:
 
     def print_spectrum(self):
         print("\n","-"*10,"Spectrum","-"*10,sep = "")
-        print("Wavelength [nm] \t Reflectence [%]")
+        print("Wavelength [nm]", *[f"{roi.name} Reflectence [%] \t Std [%]" for roi in self.rois], sep = " \t ")
         for i in range(len(self.leds)):
-            print(self.leds[i],"\t"*3,self.spectrum[i])
+            print(self.leds[i], *[f"{self.spectra[j,i]}\t{self.stds[j,i]}" for j in range(len(self.rois))], sep = "\t"*3)
 
 class FalseColorImage:
     def __init__(self,root,data,leds,angles):
@@ -236,14 +354,24 @@ class FalseColorImage:
         self.data = data
         self.leds = leds
         self.sampler_angles = angles
+        self.compositor = FalseColorCompositor(lambda led_in, angle_in: self.data[:,:,led_in,angle_in,0])
 
         self.root.title("False color image (copolarized)")
         
         #define canvas
         self.fig, self.ax = plt.subplots(figsize = (7,6), ncols=1)
-        self.canvas = FigureCanvasTkAgg(self.fig, master = self.root)
+        self.canvas_frame = tk.Frame(self.root)
+        self.canvas_frame.grid(row = 0, column = 0, columnspan = 4)
+        self.canvas = FigureCanvasTkAgg(self.fig, master = self.canvas_frame)
         self.canvas.draw()
-        self.canvas.get_tk_widget().grid(row = 0, column = 0, columnspan = 4)
+        self.canvas.get_tk_widget().pack()
+        #zoom and pan, the shown level follows the visible region
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.canvas_frame)
+        self.toolbar.update()
+        self.img = None
+        self.ax.callbacks.connect("xlim_changed", lambda ax: self.refresh_view())
+        self.ax.callbacks.connect("ylim_changed", lambda ax: self.refresh_view())
+        self.canvas.mpl_connect("resize_event", lambda event: self.refresh_view())
 
         #menubutton for leds R
         self.led_r = tk.IntVar(value = self.leds[8])
@@ -297,30 +425,15 @@ class FalseColorImage:
         self.mbtn_angles.grid(row = 1, column = 3, sticky = "nsew")
         self.current_angle.trace_add("write", lambda *args: self.update_image())
 
-        tk.Label(self.root, text = "Red gain", justify = "right").grid(row = 2, column = 0, sticky = "e")
-        
-        #gain entry
-        self.red_gain = tk.Entry(self.root, bg = "white", fg = "black", width = 7)
-        self.red_gain.grid(row = 2, column = 1, sticky = "nsew")
-        self.red_gain.insert(0,"1.0")
-
-        tk.Label(self.root, text = "Green gain", justify = "right").grid(row = 3, column = 0, sticky = "e")
-        
-        #gain entry
-        self.green_gain = tk.Entry(self.root, bg = "white", fg = "black", width = 7)
-        self.green_gain.grid(row = 3, column = 1, sticky = "nsew")
-        self.green_gain.insert(0,"1.0")
-
-        tk.Label(self.root, text = "Blue gain", justify = "right").grid(row = 4, column = 0, sticky = "e")
-        
-        #gain entry
-        self.blue_gain = tk.Entry(self.root, bg = "white", fg = "black", width = 7)
-        self.blue_gain.grid(row = 4, column = 1, sticky = "nsew")
-        self.blue_gain.insert(0,"1.0")
-
-        #button for entry
-        tk.Button(self.root, text = "Set Gains",
-                  command = self.update_image).grid(row = 2, column = 2, sticky = "ew", padx = 5, pady = 5)
+        #gain sliders, the image follows them while dragging
+        self.pending_update = None
+        self.red_gain = tk.DoubleVar(value = 1.0)
+        self.green_gain = tk.DoubleVar(value = 1.0)
+        self.blue_gain = tk.DoubleVar(value = 1.0)
+        for row, name, gain in [(2, "Red gain", self.red_gain), (3, "Green gain", self.green_gain), (4, "Blue gain", self.blue_gain)]:
+            tk.Label(self.root, text = name, justify = "right").grid(row = row, column = 0, sticky = "e")
+            tk.Scale(self.root, variable = gain, from_ = 0.0, to = 5.0, resolution = 0.01, orient = tk.HORIZONTAL,
+                     command = self.schedule_update).grid(row = row, column = 1, columnspan = 2, sticky = "nsew")
 
         #save image
         tk.Button(self.root, text = "Save image",
@@ -332,7 +445,14 @@ class FalseColorImage:
 
         self.update_image()
 
+    def schedule_update(self, *args):
+        #at most one redraw every 30 ms while a slider is dragged, the redraw reads the latest values
+        if self.pending_update is not None:
+            return
+        self.pending_update = self.root.after(30, self.update_image)
+
     def update_image(self):
+        self.pending_update = None
         r_in = self.leds.index(self.led_r.get())
         g_in = self.leds.index(self.led_g.get())
         b_in = self.leds.index(self.led_b.get())
@@ -340,21 +460,29 @@ class FalseColorImage:
         r_gain = float(self.red_gain.get())
         g_gain = float(self.green_gain.get())
         b_gain = float(self.blue_gain.get())
-        
-        false_color_im = np.stack([r_gain*self.data[:,:,r_in,angle_in,0],
-                                  g_gain*self.data[:,:,g_in,angle_in,0],
-                                  b_gain*self.data[:,:,b_in,angle_in,0]],
-                                  axis=-1)
-
-        false_color_im = np.maximum(false_color_im, 0)
-        false_color_im = np.sqrt(false_color_im)
-        self.ax.clear()
-        self.img = self.ax.imshow(false_color_im, cmap='nipy_spectral')
-        self.ax.set_xlabel('x (pixel)')
-        self.ax.set_ylabel('y (pixel)')
+
+        #slices of a running measurement can still change
+        if isinstance(self.data, LiveHyperPiCube) and not self.data.complete:
+            self.compositor.clear()
+        self.compositor.set_channel(0, (r_in, angle_in), r_gain)
+        self.compositor.set_channel(1, (g_in, angle_in), g_gain)
+        self.compositor.set_channel(2, (b_in, angle_in), b_gain)
+        if self.img is None:
+            self.img = self.ax.imshow(np.zeros((1, 1, 3)), extent = (-0.5, self.data.shape[1] - 0.5, self.data.shape[0] - 0.5, -0.5))
+            self.ax.set_xlabel('x (pixel)')
+            self.ax.set_ylabel('y (pixel)')
+            self.ax.set_autoscale_on(False)
+        self.refresh_view()
         self.ax.set_title(f"R({self.leds[r_in]}nm)    G({self.leds[g_in]}nm)    B({self.leds[b_in]}nm)")
         self.canvas.draw()
 
+    def refresh_view(self):
+        if self.img is not None:
+            bbox = self.ax.get_window_extent()
+            false_color_im, extent = self.compositor.view(self.ax.get_xlim(), self.ax.get_ylim(), (bbox.width, bbox.height))
+            self.img.set_data(false_color_im)
+            self.img.set_extent(extent)
+
     def save_image(self):
         folder_path = filedialog.askdirectory(title = "Select save folder.")
         if folder_path:
@@ -368,14 +496,27 @@ class ElipsoImage:
         self.data = data
         self.leds = leds
         self.sampler_angles = angles
+        #copol, depol and copol - depol maps are computed once per slice and only recolored with the gains
+        self.products = PolarizationProducts(self.data)
+        self.compositor = FalseColorCompositor(lambda name, led_in, angle_in: self.products.get(led_in, angle_in)[name],
+                                               sqrt = False)
 
         self.root.title("Copolarized-Depolarized image")
         
         #define canvas
         self.fig, self.ax = plt.subplots(figsize = (7,6), ncols=1)
-        self.canvas = FigureCanvasTkAgg(self.fig, master = self.root)
+        self.canvas_frame = tk.Frame(self.root)
+        self.canvas_frame.grid(row = 0, column = 0, columnspan = 3)
+        self.canvas = FigureCanvasTkAgg(self.fig, master = self.canvas_frame)
         self.canvas.draw()
-        self.canvas.get_tk_widget().grid(row = 0, column = 0, columnspan = 3)
+        self.canvas.get_tk_widget().pack()
+        #zoom and pan, the shown level follows the visible region
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.canvas_frame)
+        self.toolbar.update()
+        self.img = None
+        self.ax.callbacks.connect("xlim_changed", lambda ax: self.refresh_view())
+        self.ax.callbacks.connect("ylim_changed", lambda ax: self.refresh_view())
+        self.canvas.mpl_connect("resize_event", lambda event: self.refresh_view())
 
         #menubutton for leds
         self.current_led = tk.IntVar(value = self.leds[0])
@@ -443,20 +584,28 @@ class ElipsoImage:
         codepol_gain = float(self.codepol_gain.get())
         copol_gain = float(self.copol_gain.get())
         depol_gain = float(self.depol_gain.get())
-        
-        pol_falsecolor = np.stack([depol_gain*self.data[:,:,led_in,angle_in,1],
-                                   codepol_gain*(self.data[:,:,led_in,angle_in,0] - self.data[:,:,led_in,angle_in,1]),
-                                   copol_gain*self.data[:,:,led_in,angle_in,0]], axis=-1)
-        
-        pol_falsecolor = np.clip(pol_falsecolor, 0, 1)
-        
-        self.ax.clear()
-        self.img = self.ax.imshow(pol_falsecolor)
-        self.ax.set_xlabel('x (pixel)')
-        self.ax.set_ylabel('y (pixel)')
-        self.ax.set_title(f"R : depol    G : copol - depol")
+
+        if isinstance(self.data, LiveHyperPiCube) and not self.data.complete:
+            self.compositor.clear()
+        self.compositor.set_channel(0, ("depol", led_in, angle_in), depol_gain)
+        self.compositor.set_channel(1, ("difference", led_in, angle_in), codepol_gain)
+        self.compositor.set_channel(2, ("copol", led_in, angle_in), copol_gain)
+        if self.img is None:
+            self.img = self.ax.imshow(np.zeros((1, 1, 3)), extent = (-0.5, self.data.shape[1] - 0.5, self.data.shape[0] - 0.5, -0.5))
+            self.ax.set_xlabel('x (pixel)')
+            self.ax.set_ylabel('y (pixel)')
+            self.ax.set_title(f"R : depol    G : copol - depol")
+            self.ax.set_autoscale_on(False)
+        self.refresh_view()
         self.canvas.draw()
 
+    def refresh_view(self):
+        if self.img is not None:
+            bbox = self.ax.get_window_extent()
+            pol_falsecolor, extent = self.compositor.view(self.ax.get_xlim(), self.ax.get_ylim(), (bbox.width, bbox.height))
+            self.img.set_data(pol_falsecolor)
+            self.img.set_extent(extent)
+
     def save_image(self):
         folder_path = filedialog.askdirectory(title = "Select save folder.")
         if folder_path:
@@ -567,6 +716,17 @@ class MakeGif:
                                       command = self.make_wave_gif, width = 50, state = tk.DISABLED)
         self.wave_button.grid(row = 2, column = 0,columnspan = 4, sticky = "ns")
 
+        #file format, only the formats the installed packages can write are offered
+        self.animation_format = tk.StringVar(value = ".gif")
+        self.mbtn_format = tk.Menubutton(self.root, text = "Select format", relief = tk.RAISED)
+        self.mbtn_format.menu = tk.Menu(self.mbtn_format, tearoff = 0)
+        self.mbtn_format["menu"] = self.mbtn_format.menu
+
+        for animation_format in ANIMATION_FORMATS:
+            self.mbtn_format.menu.add_radiobutton(label = animation_format, variable = self.animation_format, value = animation_format)
+
+        self.mbtn_format.pack()
+
     def enable_angle_commands(self):
         self.mbtn_leds_r["state"] = tk.NORMAL
         self.mbtn_leds_g["state"] = tk.NORMAL
@@ -598,76 +758,75 @@ class MakeGif:
         g_in = self.leds.index(self.led_g.get())
         b_in = self.leds.index(self.led_b.get())
         pol_in = self.polar_angles.index(self.polar_angle.get())
-        frames = []
-        font = ImageFont.truetype('arial.ttf', 24)
-        for angle_in in range(len(self.sampler_angles)):
-            rgb_data = np.stack([self.data[:,:,r_in, angle_in, pol_in],
-                                             self.data[:,:,g_in, angle_in, pol_in],
-                                             self.data[:,:,b_in, angle_in, pol_in]
-                                            ], axis=-1)
-            rgb_data = (rgb_data / rgb_data.max() * 255).astype(np.uint8)
-            img = Image.fromarray(rgb_data)
-            draw = ImageDraw.Draw(img)
-            angle_text = f"Angle: {self.sampler_angles[angle_in]}°"
-            text_width, text_height = draw.textbbox((0,0), angle_text, font=font)[2:]
-            x_pos = 10
-            y_pos = 10
-            draw.rectangle((x_pos, y_pos, x_pos+text_width, y_pos+text_height), fill=(255, 255, 255))
-            draw.text((x_pos, y_pos), angle_text, font=font, fill=(0, 0, 0))
-            frames.append(img)
 
         save_path = filedialog.askdirectory(title = "Select save folder.")
         if save_path:
-            gif_path = os.path.join(save_path,'RGB_angles_gif.gif')
-            frames[0].save(gif_path, save_all = True, append_images = frames[1:], duration = 1000, loop=0)
+            #frames are written while the next ones are rendered
+            gif_path = render_angle_animation(self.data, (r_in, g_in, b_in), self.sampler_angles, pol_in,
+                                              os.path.join(save_path,'RGB_angles_gif' + self.animation_format.get()))
             print(f'GIF saved at {gif_path}!')
             self.root.destroy()                                 
                                              
     def make_wave_gif(self):
         angle_in = self.sampler_angles.index(self.current_angle.get())
         pol_in = self.polar_angles.index(self.polar_angle.get())
-        frames = []
-        font = ImageFont.truetype('arial.ttf', 24)
-        for wave_in in range(len(self.leds)):
-            wavelength_data = self.data[:, :, wave_in, angle_in, pol_in]
-            wavelength_data = (wavelength_data / wavelength_data.max() * 255).astype(np.uint8)
-            #img = Image.fromarray(wavelength_data)
-            img = Image.fromarray(cm.jet(wavelength_data/255.0, bytes=True))
-            
-            draw = ImageDraw.Draw(img)
-            wavelength_text = f"Wavelength: {self.leds[wave_in]} nm"
-            text_width, text_height = draw.textbbox((0,0), wavelength_text, font=font)[2:]
-            x_pos = 10
-            y_pos = 10
-            draw.rectangle((x_pos, y_pos, x_pos+text_width, y_pos+text_height), fill=(255,255,255))
-            draw.text((x_pos, y_pos), wavelength_text, font=font, fill=(0,0,0))
-
-            draw_cb = ImageDraw.Draw(img)
-            color_bar_width = 20
-            color_bar_height = img.height
-            x_pos_cb = img.width - color_bar_width
-            y_pos_cb = img.height
-            for j in range(color_bar_height):
-                color_val = j / color_bar_height
-                r, g, b, _ = cm.jet(color_val)
-                color = (int(r * 255), int(g * 255), int(b * 255))
-                draw_cb.rectangle((x_pos_cb, y_pos_cb - j, x_pos_cb + color_bar_width, y_pos_cb - j - 1), fill=color)
-            
-            frames.append(img)
 
         save_path = filedialog.askdirectory(title = "Select save folder.")
         if save_path:
-            gif_path = os.path.join(save_path,'Wavelength_gif.gif')
-            frames[0].save(gif_path, save_all=True, append_images=frames[1:], duration=1000, loop=0)
+            gif_path = render_wavelength_animation(self.data, self.leds, angle_in, pol_in,
+                                                   os.path.join(save_path,'Wavelength_gif' + self.animation_format.get()))
             print(f'GIF saved at {gif_path}!')
             self.root.destroy() 
 
+class CalibrationList:
+    def __init__(self, root, on_load):
+        self.root = root
+        self.on_load = on_load
+        self.root.title("Stored reference calibrations")
+
+        self.listbox = tk.Listbox(self.root, width = 120, height = 12)
+        self.listbox.grid(row = 0, column = 0, columnspan = 3, sticky = "nsew", padx = 5, pady = 5)
+
+        tk.Button(self.root, text = "Load calibration",
+                  command = self.load).grid(row = 1, column = 0, sticky = "ew", padx = 5, pady = 5)
+        tk.Button(self.root, text = "Evict unused for 30 days",
+                  command = self.evict).grid(row = 1, column = 1, sticky = "ew", padx = 5, pady = 5)
+        tk.Button(self.root, text = "Close window",
+                  command = self.root.destroy).grid(row = 1, column = 2, sticky = "ew", padx = 5, pady = 5)
+
+        self.refresh()
+
+    def refresh(self):
+        self.calibrations = list_calibrations()
+        self.listbox.delete(0, tk.END)
+        for calibration in self.calibrations:
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(calibration["last_used"]))
+            self.listbox.insert(tk.END, f"{last_used}    R : {calibration['reflectance']}    Exposure : {calibration['ExposureTime']}"
+                                        f"    Gain : {calibration['AnalogueGain']}    {calibration['folder_path']}")
+
+    def load(self):
+        selection = self.listbox.curselection()
+        if selection:
+            calibration = load_calibration(self.calibrations[selection[0]]["key"])
+            if calibration is None:
+                print("The selected calibration could not be read")
+                self.refresh()
+            else:
+                self.on_load(calibration)
+                self.root.destroy()
+
+    def evict(self):
+        evicted = evict_calibrations(older_than_days = 30)
+        print(f"{len(evicted)} calibrations evicted")
+        self.refresh()
+
 class Data_analysis:
     def __init__(self, root, leds):
         self.root = root
         self.reference = None
         self.flatfield_shape = None
         self.hyperpi_data = None
+        self.statistics = CubeStatistics()
         self.leds = leds
         self.sample_angles = None
         self.root.title("Data analysis console for HyperPi project")
@@ -706,6 +865,32 @@ class Data_analysis:
         self.meas_folder_entry.grid(row = 1, column = 1, columnspan = 2,
                                          sticky = "ew", padx = 5, pady = 5)
 
+        tk.Button(self.header, text = "Stored calibrations",
+                  command = self.open_calibrations).grid(row = 2, column = 0, sticky = "ew", padx = 5, pady = 5)
+
+        #keep the measurements cube in a file on disk instead of RAM
+        self.disk_backed = tk.BooleanVar(value = False)
+        self.disk_backed_check = tk.Checkbutton(self.header, text = "Disk-backed cube (for scans larger than RAM)",
+                                                variable = self.disk_backed, command = self.set_loading_mode)
+        self.disk_backed_check.grid(row = 2, column = 1, sticky = "w", padx = 5, pady = 5)
+
+        #decode each LED/angle/polarization image only when a viewer asks for it
+        self.lazy_loading = tk.BooleanVar(value = False)
+        self.lazy_loading_check = tk.Checkbutton(self.header, text = "Lazy loading (read images on demand)",
+                                                 variable = self.lazy_loading, command = self.set_loading_mode)
+        self.lazy_loading_check.grid(row = 2, column = 2, sticky = "w", padx = 5, pady = 5)
+
+        #time every loading stage and save the trace next to the data
+        self.profile_loading = tk.BooleanVar(value = False)
+        tk.Checkbutton(self.header, text = "Profile loading",
+                       variable = self.profile_loading).grid(row = 2, column = 3, sticky = "w", padx = 5, pady = 5)
+
+        #follow a measurement that is still being acquired
+        tk.Button(self.header, text = "Watch running measurement",
+                  command = self.watch_measurements).grid(row = 3, column = 0, sticky = "ew", padx = 5, pady = 5)
+        self.live_status = tk.Label(self.header, text = "")
+        self.live_status.grid(row = 3, column = 1, columnspan = 2, sticky = "w", padx = 5, pady = 5)
+
         #set left-column/monochromatic image
         tk.Button(self.left_col, text = "Generate Monochromatic Image",
                   command = self.gen_monochromatic, width = 35).pack()#.grid(row = 0, column = 0, sticky = "ns", padx = 5, pady = 5)
@@ -722,27 +907,110 @@ class Data_analysis:
         tk.Button(self.root, text = "Make gifs",
                   command = self.make_gif).grid(row = 2, column = 0, columnspan = 3, sticky = "nsew")
 
-    def get_reference(self, progress_window, callback):
-        self.reference, self.flatfield_shape, folder_path = read_reference(0.7)
+    def set_loading_mode(self):
+        #a lazy cube never fills a disk-backed one, so only one of them can be ticked
+        self.lazy_loading_check.config(state = "disabled" if self.disk_backed.get() else "normal")
+        self.disk_backed_check.config(state = "disabled" if self.lazy_loading.get() else "normal")
+
+    def get_reference(self, progress_window, callback, progress=None, cancel_event=None):
+        profiler = StageProfiler() if self.profile_loading.get() else None
+        #the progress window is closed whatever happens to the loader
+        try:
+            self.reference, self.flatfield_shape, folder_path = read_reference(0.7, profiler = profiler, progress = progress,
+                                                                               cancel_event = cancel_event)
+        except LoadCancelled:
+            print("Reading of the reference cancelled")
+            return
+        except Exception as e:
+            print(f"Error while reading the reference: {str(e)}")
+            return
+        finally:
+            progress_window.after(0, callback)
         if folder_path:
             self.reference_folder_entry.delete(0, tk.END)
             self.reference_folder_entry.insert(0, folder_path)
 
-        progress_window.after(0, callback)
-
         print(f"Reference read from {folder_path}")
+        self.save_profile(profiler, folder_path)
 
-    def get_measurements(self,progress_window,callback):
-        self.hyperpi_data, folder_path, angles = read_hyperpi_data(self.reference,self.flatfield_shape)
+    def open_calibrations(self):
+        new_window = tk.Toplevel(self.root)
+        calibration_window = CalibrationList(new_window, self.set_calibration)
+
+    def set_calibration(self, calibration):
+        self.reference, self.flatfield_shape, metadata = calibration
+        self.reference_folder_entry.delete(0, tk.END)
+        self.reference_folder_entry.insert(0, metadata["folder_path"])
+        print(f"Reference calibration loaded for {metadata['folder_path']}")
+
+    def get_measurements(self,progress_window,callback,progress=None,cancel_event=None):
+        self.stop_watching()
+        profiler = StageProfiler() if self.profile_loading.get() else None
+        statistics = CubeStatistics()
+        #the progress window is closed whatever happens to the loader
+        try:
+            hyperpi_data, folder_path, angles = read_hyperpi_data(self.reference,self.flatfield_shape,
+                                                                  memmap = self.disk_backed.get(),
+                                                                  lazy = self.lazy_loading.get(),
+                                                                  profiler = profiler,
+                                                                  progress = progress,
+                                                                  cancel_event = cancel_event,
+                                                                  statistics = statistics)
+        except LoadCancelled:
+            #the partially filled cube is dropped by the loader
+            print("Reading of measurements cancelled")
+            return
+        except Exception as e:
+            print(f"Error while reading the measurements: {str(e)}")
+            return
+        finally:
+            progress_window.after(0, callback)
+        self.hyperpi_data = hyperpi_data
+        self.statistics = statistics
         if folder_path:
             self.meas_folder_entry.delete(0, tk.END)
             self.meas_folder_entry.insert(0, folder_path)
 
-        self.sample_angles = [float(txt.strip().split("_")[-1]) for txt in angles]
-
-        progress_window.after(0, callback)
+        self.sample_angles = folder_angles(angles)
 
         print(f"Measurements read from {folder_path}")
+        #quality check of the frames, from the statistics taken while reading
+        for warning in statistics.quality_report(self.leds, self.sample_angles):
+            print("Warning,", warning)
+        self.save_profile(profiler, folder_path)
+
+    def save_profile(self, profiler, folder_path):
+        if profiler is not None and folder_path:
+            profiler.report()
+            file_path = profiler.save(folder_path)
+            if file_path:
+                print("Loading profile saved at:",file_path,sep='\n')
+
+    def watch_measurements(self):
+        if self.reference is None:
+            print("Please, read the reference before watching a measurement")
+            return
+        self.stop_watching()
+        self.hyperpi_data, folder_path = watch_hyperpi_data(self.reference, self.flatfield_shape)
+        self.statistics = CubeStatistics()
+        self.meas_folder_entry.delete(0, tk.END)
+        self.meas_folder_entry.insert(0, folder_path)
+        print(f"Watching measurements at {folder_path}")
+        self.refresh_live()
+
+    def refresh_live(self):
+        if isinstance(self.hyperpi_data, LiveHyperPiCube):
+            #viewers opened from now on see every sampler angle that has arrived
+            self.sample_angles = self.hyperpi_data.angles
+            status = "complete" if self.hyperpi_data.complete else "acquiring"
+            self.live_status["text"] = (f"Live ({status}) : {self.hyperpi_data.frames_read} images read,"
+                                        f" {len(self.sample_angles)} sampler angles")
+            self.root.after(1000, self.refresh_live)
+
+    def stop_watching(self):
+        if isinstance(self.hyperpi_data, LiveHyperPiCube):
+            self.hyperpi_data.stop()
+            self.live_status["text"] = ""
 
     def open_progress_bar(self,process,function):
         progress_window = tk.Toplevel(self.root)
@@ -752,22 +1020,56 @@ class Data_analysis:
                  text=f"After selecting {process} folder, the reading will start.").pack(pady = 10)
     
         progress_bar = ttk.Progressbar(progress_window, orient="horizontal",
-                                       length=300, mode="indeterminate")
+                                       length=300, mode="determinate")
         progress_bar.pack(pady=10)
 
-        tk.Label(progress_window,
-                 text="Please, wait for this window to close.").pack(pady = 10)
-            
-        progress_bar.start()
+        status = tk.Label(progress_window, text="Waiting for the folder...")
+        status.pack(pady = 10)
+
+        #the loader runs in a worker thread and only talks to Tk through this queue
+        progress_queue = queue.Queue()
+        cancel_event = threading.Event()
+        closed = threading.Event()
+
+        def progress(done, total, nbytes):
+            progress_queue.put((done, total, nbytes, time.time()))
+
+        def cancel():
+            cancel_event.set()
+            status["text"] = "Cancelling..."
+
+        tk.Button(progress_window, text = "Cancel", command = cancel).pack(pady = 10)
+        progress_window.protocol("WM_DELETE_WINDOW", cancel)
+
+        start_time = []
+        def poll():
+            if closed.is_set():
+                return
+            latest = None
+            while not progress_queue.empty():
+                latest = progress_queue.get_nowait()
+            if latest is not None and not cancel_event.is_set():
+                done, total, nbytes, now = latest
+                if not start_time:
+                    start_time.append(now)
+                elapsed = now - start_time[0]
+                rate = nbytes / elapsed / 2**20 if elapsed > 0 else 0.0
+                eta = f"{elapsed * (total - done) / done:.0f} s" if done else "--"
+                progress_bar["maximum"] = max(total, 1)
+                progress_bar["value"] = done
+                status["text"] = f"{done}/{total} frames    {rate:.1f} MB/s    Time left : {eta}"
+            progress_window.after(100, poll)
+
         def close_progress_window():
-            progress_bar.stop()
+            closed.set()
             progress_window.destroy()
 
-        threading.Thread(target = function, args = (progress_window,close_progress_window)).start()
+        poll()
+        threading.Thread(target = function, args = (progress_window,close_progress_window,progress,cancel_event)).start()
 
     def gen_monochromatic(self):
         new_window = tk.Toplevel(self.root)
-        new_mono = Monochromatic_image(new_window,self.hyperpi_data,self.leds,self.sample_angles)
+        new_mono = Monochromatic_image(new_window,self.hyperpi_data,self.leds,self.sample_angles,self.statistics)
 
     def gen_false_color_image(self):
         new_window = tk.Toplevel(self.root)
@@ -781,14 +1083,15 @@ class Data_analysis:
         new_window = tk.Toplevel(self.root)
         new_makegif = MakeGif(new_window,self.hyperpi_data,self.leds,self.sample_angles)
 
-try:
-    window = tk.Tk()
-
-    app = Data_analysis(window, LEDs)
-    window.mainloop()
-finally:
+if __name__ == "__main__":
     try:
-        window.destroy()
-    except:
-        pass
-    print("Bye")
+        window = tk.Tk()
+
+        app = Data_analysis(window, LEDs)
+        window.mainloop()
+    finally:
+        try:
+            window.destroy()
+        except:
+            pass
+        print("Bye")